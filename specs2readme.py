@@ -14,26 +14,30 @@ Options:
   -2 --two-columns         Use two columns table format instead of three columns [default: no]
   -n --no-diff             Emit all variables, not only the specs not already in README.md [default: no]
 """
-import typing
 import yaml
-import docopt
-import glob
+import os
+import hashlib
+import json
+import tempfile
+import mmap
 import re
 
-from yaml.composer import Composer
-from yaml.constructor import Constructor
-from yaml.nodes import ScalarNode
-from yaml.resolver import BaseResolver
-from yaml.loader import SafeLoader
-
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 
-LINE_NUMBER_KEY: str = "__line__"
 ARGUMENTS_SPEC_FILE: str = "argument_specs.yml"
 ARGUMENTS_SPEC_PATH: str = "/meta/" + ARGUMENTS_SPEC_FILE
+SPECS_CACHE_DIR_NAME: str = "ansible-specs"
 MD_MARKER_START: str = "<!--start argument_specs-->"
 MD_MARKER_END: str = "<!--end argument_specs-->"
+_MD_MARKER_START_BYTES: bytes = MD_MARKER_START.encode()
+_MD_MARKER_END_BYTES: bytes = MD_MARKER_END.encode()
 
 VARS_REGEX       = r"^[|]\s*[`](.*?)[`]\s*[|].*[|]$"
 VARS_TITLE:  str = """\
@@ -63,34 +67,42 @@ DEFAULTS_HEADER_2COLS: str = """\
 |:---------|:------------|
 """
 
+_VARS_RE = re.compile(VARS_REGEX, re.M)
+_DEFAULTS_RE = re.compile(DEFAULTS_REGEX, re.M)
 
-class LineLoader(SafeLoader):
+
+def load_specs_cached(path, update_cache: bool = True) -> dict:
     """
-    Custom LineLoader which return line number for all variables
-    (not just parsed nodes).
+    parse an argument_specs file, reusing a cached copy while the file is unchanged;
+    entries are keyed on the file path so a new version replaces the old one
     """
-    def __init__(self, stream):
-        super(LineLoader, self).__init__(stream)
-
-    def compose_node(self, parent, index):
-        # the line number where the previous token has ended (plus empty lines)
-        line = self.line
-        node = Composer.compose_node(self, parent, index)
-        node.__line__ = line + 1
-        return node
-
-    def construct_mapping(self, node, deep=False):
-        node_pair_lst = node.value
-        node_pair_lst_for_appending = []
-
-        for key_node, value_node in node_pair_lst:
-            shadow_key_node = ScalarNode(tag=BaseResolver.DEFAULT_SCALAR_TAG, value=LINE_NUMBER_KEY + key_node.value)
-            shadow_value_node = ScalarNode(tag=BaseResolver.DEFAULT_SCALAR_TAG, value=key_node.__line__)
-            node_pair_lst_for_appending.append((shadow_key_node, shadow_value_node))
-
-        node.value = node_pair_lst + node_pair_lst_for_appending
-        mapping = Constructor.construct_mapping(self, node, deep=deep)
-        return mapping
+    stat = os.stat(path)
+    cache_file = None
+    try:
+        # resolved here so that an unknown home directory only disables the cache;
+        # an empty XDG_CACHE_HOME counts as unset
+        cache_dir = Path(os.environ.get("XDG_CACHE_HOME") or Path.home() / ".cache") / SPECS_CACHE_DIR_NAME
+        cache_file = cache_dir / (hashlib.sha256(os.path.abspath(path).encode()).hexdigest() + ".json")
+        with open(cache_file, 'r') as f:
+            cached = json.load(f)
+        if cached['mtime_ns'] == stat.st_mtime_ns and cached['size'] == stat.st_size:
+            return cached['specs']
+    except (OSError, RuntimeError, ValueError, KeyError, TypeError):
+        pass
+    with open(path, 'r') as f:
+        specs = yaml.load(f, Loader=SafeLoader)
+    if update_cache and cache_file is not None:
+        try:
+            text = json.dumps({ 'mtime_ns': stat.st_mtime_ns, 'size': stat.st_size, 'specs': specs })
+            # only cache specs that survive the round trip, e.g. no dates or non-string keys
+            if json.loads(text)['specs'] == specs:
+                cache_file.parent.mkdir(parents=True, exist_ok=True)
+                with tempfile.NamedTemporaryFile('w', dir=cache_file.parent, delete=False) as tmp:
+                    tmp.write(text)
+                os.replace(tmp.name, cache_file)
+        except (OSError, TypeError, ValueError):
+            pass
+    return specs
 
 
 class Specs2Readme:
@@ -117,52 +129,69 @@ class Specs2Readme:
     def lookup_roles(self) -> list:
         """ find roles """
         if self.collection:
-            return [
-                Path(role).name
-                for role in glob.glob(str(self.role_dir)+'/**/')
-            ]
+            try:
+                with os.scandir(self.role_dir) as it:
+                    return [e.name for e in it if not e.name.startswith('.') and e.is_dir()]
+            except OSError:
+                return []
         return [self.role_dir.name]
 
 
-    def get_readme_arguments_marker(self, role: str):
+    def role_path(self, role: str) -> Path:
+        """ directory of role """
         if self.collection:
-            readme_path: Path = self.role_dir / role / "README.md"
-        else:
-            readme_path: Path = self.role_dir / "README.md"
-        if not readme_path.exists():
-            print("error: %s not found for role `%s`" % (readme_path, role))
-            exit(2)
-        with open(str(readme_path), 'r') as f:
-            contents = f.read()
-            return contents[contents.find(MD_MARKER_START)+len(MD_MARKER_START):contents.find(MD_MARKER_END)]
-        return None
+            return self.role_dir / role
+        return self.role_dir
+
+
+    def get_readme_arguments_marker(self, readme_path: Path):
+        with open(str(readme_path), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as contents:
+                start = contents.find(_MD_MARKER_START_BYTES)
+                end = contents.find(_MD_MARKER_END_BYTES)
+                if start < 0 or end < 0:
+                    return None
+                section = contents[start+len(_MD_MARKER_START_BYTES):end]
+                return section.decode('utf-8').replace('\r\n', '\n')
 
 
     def load_documented_specs(self, readme: str) -> dict:
-        return { "defaults": re.findall(DEFAULTS_REGEX, readme, re.M), "vars": re.findall(VARS_REGEX, readme, re.M) }
+        return { "defaults": set(_DEFAULTS_RE.findall(readme)), "vars": set(_VARS_RE.findall(readme)) }
 
 
-    def append_to_readme(self, role: str, newdefs: list, newvars: list):
-        if self.collection:
-            readme_path: Path = self.role_dir / role / "README.md"
-        else:
-            readme_path: Path = self.role_dir / "README.md"
+    def append_to_readme(self, role: str, readme_path: Path, newdefs: list, newvars: list):
         with open(str(readme_path), 'r+') as fd:
-            contents = fd.readlines()
+            contents = fd.read()
+            sections = []
             if len(newdefs) > 0:
-                for index, line in enumerate(contents):
-                    if DEFAULTS_TITLE in (contents[index - 1] + line):
-                        contents.insert(index + 2, DEFAULTS_HEADER+'\n'.join(newdefs)+'\n\n\n')
-                        break
+                sections.append((DEFAULTS_TITLE, DEFAULTS_HEADER+'\n'.join(newdefs)+'\n\n\n'))
             if len(newvars) > 0:
-                for index, line in enumerate(contents):
-                    if VARS_TITLE in (contents[index - 1] + line):
-                        contents.insert(index + 2, VARS_HEADER+'\n'.join(newvars)+'\n\n\n')
-                        break
+                sections.append((VARS_TITLE, VARS_HEADER+'\n'.join(newvars)+'\n\n\n'))
             if len(newdefs) + len(newvars) > 0:
                 fd.seek(0)
                 print("writing updated README.md for role %s" % role)
-                fd.writelines(contents)
+                fd.write(self.insert_sections(contents, sections))
+                fd.truncate()
+
+
+    def insert_sections(self, contents: str, sections: list) -> str:
+        """ insert each (title, section) at the line following the blank line after title """
+        inserts = []
+        for title, section in sections:
+            pos = contents.find(title)
+            if pos < 0:
+                continue
+            eol = contents.find('\n', pos + len(title))
+            inserts.append((eol + 1 if eol >= 0 else len(contents), section))
+        chunks = []
+        start = 0
+        for index, section in sorted(inserts, key=lambda insert: insert[0]):
+            chunks += [contents[start:index], section]
+            start = index
+        chunks.append(contents[start:])
+        return ''.join(chunks)
 
 
     def row_format_default(self, var_name: str, var_spec: dict):
@@ -179,42 +208,60 @@ class Specs2Readme:
 
     def generate(self):
         roles = self.lookup_roles()
-        for role in roles:
-            print("Parsing role %s" % role)
-            readme_section = self.get_readme_arguments_marker(role)
-            if (readme_section is None):
-                print("error: no argument_specs markers found in README.md for role %s", role)
-                exit(3)
-            documented_vars = self.load_documented_specs(readme_section)
-            if self.collection:
-                specs_path: Path = self.role_dir / role / "meta" / "argument_specs.yml"
-            else:
-                specs_path: Path = self.role_dir / "meta" / "argument_specs.yml"
-            if not specs_path.exists():
-                print("error: argument_specs not found for role %s" % role)
-                exit(1)
-            new_vars = { 'vars': [], 'defaults': []}
-            with open(specs_path, 'r') as f:
-                argument_specs = yaml.load(f, Loader=LineLoader)['argument_specs']['main']['options']
-                for var in filter(lambda k: not k.startswith(LINE_NUMBER_KEY), argument_specs.keys() if argument_specs is not None else []):
-                    if 'default' in argument_specs[var] and (not var in documented_vars['defaults'] or self.emit_all):
-                        print("found missing argument_specs DEFAULT %s to README.md" % var)
-                        new_vars["defaults"].append(self.row_format_default(var, argument_specs[var]))
-                    if 'default' not in argument_specs[var] and (not var in documented_vars['vars'] or self.emit_all):
-                        print("found missing argument_specs REQUIRED VAR %s to README.md" % var)
-                        new_vars["vars"].append(self.row_format_variable(var, argument_specs[var]))
-
-            if not self.write_stdout:
-               self.append_to_readme(role, new_vars['defaults'], new_vars['vars'])
-            else:
-               print(DEFAULTS_HEADER_2COLS if self.two_columns else DEFAULTS_HEADER, end='')
-               print('\n'.join(new_vars['defaults']))
-               print('\n')
-               print(VARS_HEADER_2COLS if self.two_columns else VARS_HEADER, end='')
-               print('\n'.join(new_vars['vars']))
+        with ThreadPoolExecutor(max_workers=max(1, min(32, len(roles)))) as executor:
+            futures = [executor.submit(self.parse_role, role) for role in roles]
+            for role, future in zip(roles, futures):
+                output, status, new_vars = future.result()
+                print('\n'.join(output))
+                if status:
+                    executor.shutdown(wait=False, cancel_futures=True)
+                    exit(status)
+                self.write_role(role, new_vars)
+
+
+    def parse_role(self, role: str):
+        """ compare a role's argument_specs with its README.md, returning (output lines, exit status, new rows) """
+        output = ["Parsing role %s" % role]
+        role_path = self.role_path(role)
+        try:
+            readme_section = self.get_readme_arguments_marker(role_path / "README.md")
+        except FileNotFoundError:
+            output.append("error: %s not found for role `%s`" % (role_path / "README.md", role))
+            return output, 2, None
+        if (readme_section is None):
+            output.append("error: no argument_specs markers found in README.md for role %s" % role)
+            return output, 3, None
+        documented_vars = self.load_documented_specs(readme_section)
+        try:
+            argument_specs = load_specs_cached(role_path / "meta" / ARGUMENTS_SPEC_FILE, not self.write_stdout)['argument_specs']['main']['options']
+        except FileNotFoundError:
+            output.append("error: argument_specs not found for role %s" % role)
+            return output, 1, None
+        new_vars = { 'vars': [], 'defaults': []}
+        for var, spec in (argument_specs or {}).items():
+            has_default = 'default' in spec
+            if has_default and (var not in documented_vars['defaults'] or self.emit_all):
+                output.append("found missing argument_specs DEFAULT %s to README.md" % var)
+                new_vars["defaults"].append(self.row_format_default(var, spec))
+            elif not has_default and (var not in documented_vars['vars'] or self.emit_all):
+                output.append("found missing argument_specs REQUIRED VAR %s to README.md" % var)
+                new_vars["vars"].append(self.row_format_variable(var, spec))
+        return output, 0, new_vars
+
+
+    def write_role(self, role: str, new_vars: dict):
+        """ update README.md for a single role, or print its new rows on dry-run """
+        if not self.write_stdout:
+           self.append_to_readme(role, self.role_path(role) / "README.md", new_vars['defaults'], new_vars['vars'])
+        else:
+           print((DEFAULTS_HEADER_2COLS if self.two_columns else DEFAULTS_HEADER)
+                 + '\n'.join(new_vars['defaults']) + '\n\n\n'
+                 + (VARS_HEADER_2COLS if self.two_columns else VARS_HEADER)
+                 + '\n'.join(new_vars['vars']))
 
 
 def main():
+    import docopt
     args = docopt.docopt(__doc__)
     role_dir = args['--role_dir'] or './'
     collection = args['--collection'] or False
@@ -5,66 +5,108 @@
 """Generates argument_specs.yml from variables parsed in role.
 
 Usage:
-  vars2specs.py [-c] [-i IND] [-r DIR]
+  vars2specs.py [-c] [-i IND] [-r DIR] [--validate]
 
 Options:
   -c                       Parse all roles in a collection [default: no]
   -i IND --indent IND      White space count for yaml indention. [default: 4]
   -r DIR --role_dir=DIR    Input role directory [default: ./].
+  --validate               Parse generated argument_specs back before writing [default: no]
 """
-from textwrap import indent
-import typing
 import yaml
-import docopt
-import glob
-import re
-import collections
+import json
+import io
+import os
+import functools
+import multiprocessing
 
-from ruamel.yaml import YAML
-
-from yaml.composer import Composer
-from yaml.constructor import Constructor
-from yaml.nodes import ScalarNode
-from yaml.resolver import BaseResolver
-from yaml.loader import SafeLoader
+from yaml.nodes import MappingNode
 
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-LINE_NUMBER_KEY: str = "__line__"
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
 ARGUMENTS_SPEC_FILE: str = "argument_specs.yml"
 ARGUMENTS_SPEC_PATH: str = "/meta/" + ARGUMENTS_SPEC_FILE
+# parsing a var file inline takes ~0.5 ms; a process pool costs ~8 ms to start with fork,
+# ~150 ms with spawn/forkserver (each worker re-imports this script), plus ~0.1 ms per file
+POOL_MIN_VAR_FILES: int = 50
+POOL_MIN_VAR_FILES_SPAWN: int = 1000
 ARGUMENTS_SPEC_DICT: str = """\
 argument_specs:
-    main:
-        options:
+{0}main:
+{0}{0}options:
 """
 
-class LineLoader(SafeLoader):
+def iter_top_level(stream):
     """
-    Custom LineLoader which return line number for all variables (not just parsed nodes).
+    yield (name, value, line number) for the top-level variables of a yaml stream;
+    variables holding a mapping are skipped before their value is constructed
     """
-    def __init__(self, stream):
-        super(LineLoader, self).__init__(stream)
-
-    def compose_node(self, parent, index):
-        # the line number where the previous token has ended (plus empty lines)
-        line = self.line
-        node = Composer.compose_node(self, parent, index)
-        node.__line__ = line + 1
-        return node
-
-    def construct_mapping(self, node, deep=False):
-        node_pair_lst = node.value
-        node_pair_lst_for_appending = []
-
-        for key_node, value_node in node_pair_lst:
-            shadow_key_node = ScalarNode(tag=BaseResolver.DEFAULT_SCALAR_TAG, value=LINE_NUMBER_KEY + key_node.value)
-            shadow_value_node = ScalarNode(tag=BaseResolver.DEFAULT_SCALAR_TAG, value=key_node.__line__)
-            node_pair_lst_for_appending.append((shadow_key_node, shadow_value_node))
-
-        node.value = node_pair_lst + node_pair_lst_for_appending
-        mapping = Constructor.construct_mapping(self, node, deep=deep)
-        return mapping
+    loader = SafeLoader(stream)
+    try:
+        root = loader.get_single_node()
+        if not isinstance(root, MappingNode):
+            return
+        loader.flatten_mapping(root)
+        for key_node, value_node in root.value:
+            if isinstance(value_node, MappingNode):
+                continue
+            yield key_node.value, loader.construct_object(value_node, deep=True), key_node.start_mark.line + 1
+    finally:
+        loader.dispose()
+
+
+def yaml_scalar(value) -> str:
+    """ render value as a yaml scalar; anything but bool and int becomes a double-quoted string """
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    if isinstance(value, int):
+        return str(value)
+    return json.dumps(str(value), ensure_ascii=False)
+
+
+def generate_spec(stream, var_file: str, role_dir: str, indent: int, defined_vars) -> dict:
+    """ parse variables from a stream of var_file contents, returning their yaml spec blocks """
+    results = {}
+    rel_path = str(Path(var_file).relative_to(role_dir))
+    key_indent = " " * 3 * indent
+    spec_indent = " " * 4 * indent
+    todo_description = yaml_scalar("TODO document argument")
+    for var_name, value, linenumber in iter_top_level(stream):
+        try:
+            description = yaml_scalar(defined_vars[var_name]['description'])
+        except KeyError:
+            description = todo_description
+        try:
+            vartype = defined_vars[var_name]['type']
+        except KeyError:
+            vartype = type(value).__name__ if value is not None else "str"
+        if value is None:
+            default = "required: true"
+        elif vartype in [ "bool", "int" ]:
+            default = f"default: {yaml_scalar(value)}"
+        else:
+            default = f"default: {yaml_scalar(str(value))}"
+        results[var_name] = (f"{key_indent}# line {linenumber} of {rel_path}\n"
+                             f"{key_indent}{var_name}:\n"
+                             f"{spec_indent}{default}\n"
+                             f"{spec_indent}description: {description}\n"
+                             f"{spec_indent}type: {yaml_scalar(vartype)}\n")
+    return results
+
+
+def parse_var_file(var_file: str, defined_vars, role_dir: str, indent: int) -> dict:
+    """ read and parse a var file; module level so it can run in a worker process """
+    with open(var_file, 'r') as f:
+        # parse from memory, but keep the file name in yaml error marks
+        stream = io.StringIO(f.read())
+    stream.name = var_file
+    return generate_spec(stream, var_file, role_dir, indent, defined_vars)
 
 
 class Vars2Specs:
@@ -74,110 +116,130 @@ class Vars2Specs:
     role_dir: Path
     collection: bool
     indent: int = 4
+    validate: bool = False
 
     def __init__(self, role: str, collection: bool):
         self.collection = collection
         self.role_dir: Path = Path(role)
+        self.clear_cache()
         if collection:
             self.role_dir = self.role_dir / "roles"
         print("Work directory: %s" % self.role_dir)
 
 
-    def lookup_roles(self):
-        """ find roles """
-        if self.collection:
-            return [
-                Path(role).name
-                for role in glob.glob(str(self.role_dir)+'/**/')
-            ]
-        return [self.role_dir.name]
+    def clear_cache(self):
+        """ forget roles and var files found by previous lookups """
+        self._roles = None
+        self._var_files = {}
 
 
-    def lookup_var_files(self, role):
-        """ find var files """
+    def lookup_roles(self):
+        """ find roles, cached until clear_cache() """
+        if self._roles is not None:
+            return self._roles
+        roles = [self.role_dir.name]
         if self.collection:
-            return glob.glob(str(self.role_dir)+'/'+role+'/defaults/*.yml') + glob.glob(str(self.role_dir)+'/'+role+'/vars/*.yml')
-        return glob.glob(str(self.role_dir)+'/defaults/*.yml') + glob.glob(str(self.role_dir)+'/vars/*.yml')
-
-
-    def quote_default(self, value, vartype):
-        escaped = re.sub('\\\\', "\\\\\\\\", str(value))
-        return '"' + escaped + '"' if vartype not in [ "bool", "int" ] else value
+            try:
+                with os.scandir(self.role_dir) as it:
+                    roles = [e.name for e in it if not e.name.startswith('.') and e.is_dir()]
+            except OSError:
+                roles = []
+        self._roles = roles
+        return roles
 
 
-    def generate_spec(self, path: Path, defined_vars):
-        """ parse variables """
-        results = []
-        variables = yaml.load(path, Loader=LineLoader)
-        rel_path = Path(path.name).relative_to(self.role_dir)
-        for var_name in filter(lambda k: not k.startswith(LINE_NUMBER_KEY) and not isinstance(variables[k],dict), variables.keys()):
-            linenumber = variables[LINE_NUMBER_KEY + var_name]
-            try:
-                description = defined_vars[var_name]['description']
-            except KeyError:
-                description = "TODO document argument"
+    def lookup_var_files(self, role):
+        """ find var files, cached until clear_cache() """
+        if role in self._var_files:
+            return self._var_files[role]
+        role_path = str(self.role_dir) + '/' + role if self.collection else str(self.role_dir)
+        var_files = []
+        for var_dir in (role_path + '/defaults', role_path + '/vars'):
             try:
-                vartype = defined_vars[var_name]['type']
-            except KeyError:
-                vartype = type(variables[var_name]).__name__ if variables[var_name] is not None else "str"
-            default = "default: %s" % self.quote_default(variables[var_name], vartype) if variables[var_name] is not None else 'required: true'
-            results.append("""%s# line %s of %s
-            %s:
-                %s
-                description: "%s"
-                type: "%s"
-            """ % ((" "*3*self.indent), linenumber, str(rel_path), var_name, default, description, vartype))
-        return results
+                with os.scandir(var_dir) as it:
+                    var_files.extend(e.path for e in it if e.name.endswith('.yml') and not e.name.startswith('.') and e.is_file())
+            except OSError:
+                continue
+        self._var_files[role] = var_files
+        return var_files
 
 
     def load_existing_specs(self, role):
         print("Parsing argument_specs for role %s" % role)
         try:
             with open(str(self.role_dir) + '/' + role + ARGUMENTS_SPEC_PATH, 'r') as specs:
-                specs = yaml.load(specs, Loader=LineLoader)
+                specs = yaml.load(specs, Loader=SafeLoader)
                 return specs['argument_specs']['main']['options']
         except:
             return {}
 
 
+    def validate_spec(self, role, text: str, var_names: list):
+        """ parse generated argument_specs back and check all variables are there """
+        options = yaml.load(text, Loader=SafeLoader)['argument_specs']['main']['options']
+        if list(options) != var_names:
+            print("error: generated argument_specs for role %s do not match parsed variables" % role)
+            exit(4)
+
+
+    def use_process_pool(self, count: int) -> bool:
+        """ parse in worker processes only with several cpus and enough var files to repay the pool start-up """
+        if (os.cpu_count() or 1) < 2:
+            return False
+        # read the start method without fixing the default context for later set_start_method() calls
+        method = multiprocessing.get_start_method(allow_none=True) or multiprocessing.get_all_start_methods()[0]
+        if method == 'fork':
+            return count >= POOL_MIN_VAR_FILES
+        return count >= POOL_MIN_VAR_FILES_SPAWN
+
+
     def generate(self):
         """ write argument specs """
-        yaml = YAML()
-        yaml.preserve_quotes = True
-        yaml.indent(mapping = self.indent)
-        yaml.width = 800
-
-        variable_specs = collections.defaultdict(list)
         roles = self.lookup_roles()
+        tasks = []
         for role in roles:
             defined_vars = self.load_existing_specs(role)
             for var_file in self.lookup_var_files(role):
                 print("Parsing %s for role %s" % (var_file, role))
-                with open(var_file, 'r') as f:
-                    variable_specs[role] += self.generate_spec(f, defined_vars)
-
-        root_yml = yaml.load(ARGUMENTS_SPEC_DICT)
+                tasks.append((role, var_file, defined_vars))
+
+        parse = functools.partial(parse_var_file, role_dir=str(self.role_dir), indent=self.indent)
+        var_files = [var_file for _, var_file, _ in tasks]
+        defined = [defined_vars for _, _, defined_vars in tasks]
+        if self.use_process_pool(len(tasks)):
+            with ProcessPoolExecutor(max_workers=min(os.cpu_count() or 1, len(tasks))) as executor:
+                results = list(executor.map(parse, var_files, defined))
+        else:
+            results = list(map(parse, var_files, defined))
+        variable_specs = { role: {} for role in roles }
+        for (role, _, _), specs in zip(tasks, results):
+            variable_specs[role].update(specs)
+
+        header = ARGUMENTS_SPEC_DICT.format(" " * self.indent)
         for role in roles:
             specfile = str(self.role_dir)  + ARGUMENTS_SPEC_PATH
             if self.collection:
                 specfile = str(self.role_dir) + '/' + role + ARGUMENTS_SPEC_PATH
             if len(variable_specs[role]) > 0:
                 print("Writing argument_specs for role %s: %s" % (role, specfile))
+                text = header + '\n'.join(variable_specs[role].values())
+                if self.validate:
+                    self.validate_spec(role, text, list(variable_specs[role]))
                 with open(specfile, 'w') as f:
-                    code_yml = yaml.load('\n'.join(variable_specs[role]))
-                    root_yml['argument_specs']['main']['options'] = code_yml
-                    yaml.dump(root_yml, f)
+                    f.write(text)
             else:
                 print("No variables found for role directory %s" % self.role_dir)
 
 
 def main():
+    import docopt
     args = docopt.docopt(__doc__)
     role_dir = args['--role_dir'] or './'
     collection = args['-c'] or False
     v2s = Vars2Specs(role_dir, collection)
     if (args['--indent']):
         v2s.indent = int(args['--indent'])
+    v2s.validate = args['--validate'] or False
     v2s.generate()
 
 